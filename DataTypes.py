@@ -1,16 +1,19 @@
 import numpy as np
-from typing import NamedTuple, List, Dict
+from dataclasses import dataclass
+from typing import Dict, Optional
 
 """
-Custom type-definition
+Custom type-definition: the outputs of the Stages run so far, keyed by Stage name
+(a StageChannel per Stage, plus the "Disk" DataUnit).
 """
-StageEntry = Dict[str, np.ndarray]
+StageEntry = Dict[str, object]
 
 """
 Houses all of the strings needed for representing
 a collective event's data.
 """
-class MetaData(NamedTuple):
+@dataclass(frozen=True, slots=True)
+class MetaData:
      """Images' timestamp string in the form of YYYY-MM-DD HH_MM_SS"""
      timestamp: str
 
@@ -24,12 +27,13 @@ class MetaData(NamedTuple):
 Represents the loaded data for a given collection event.
 Is associated with a MetaData entry in a DataUnit instance.
 """
-class RawData(NamedTuple):
+@dataclass(frozen=True, slots=True)
+class RawData:
      """Whether or not the loaded arrays are valid (i.e., images were loaded succesfully)"""
      valid: bool
 
-     """PlantCV-compatible RGB data"""
-     rgb: np.ndarray
+     """PlantCV-compatible RGB data (HxWx3 uint8, in OpenCV's BGR channel order); None when not valid"""
+     rgb: Optional[np.ndarray]
 
      """PlantCV-compatible Depth Map data"""
      #depth: np.ndarray
@@ -37,7 +41,8 @@ class RawData(NamedTuple):
 """
 Represents all of the information related to a single collection event.
 """
-class DataUnit(NamedTuple):
+@dataclass(frozen=True, slots=True)
+class DataUnit:
      """Loaded, unprocessed RGB and Depth data"""
      raw: RawData
 
@@ -48,12 +53,14 @@ class DataUnit(NamedTuple):
 Represents the evolution of an initial collection event's data over
 the course of the pipeline's execution.
 """
-class FormattedData(NamedTuple):
+@dataclass(frozen=True, slots=True)
+class FormattedData:
      """The initial collection event data loaded from disk."""
      base: RawData # Ideally a read-only pointer (const Rawdata *const); no ownership
 
      """
      All of the outputs associated with the RawData in [base] from all of the processing 
-     units across all Stages in the pipeline.
+     units across all Stages in the pipeline, keyed by Stage name in pipeline order.
+     The "Disk" entry is the DataUnit the pipeline started from.
      """
-     proc: List[StageEntry]
\ No newline at end of file
+     proc: StageEntry
\ No newline at end of file
@@ -1,8 +1,86 @@
-import glob, sys
+import logging, os
+import cv2
 import numpy as np
-from plantcv import plantcv as pcv
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 from DataTypes import MetaData, RawData, DataUnit
 
+logger = logging.getLogger(__name__)
+
+try:
+     from numba import njit
+except ImportError: # Numba is optional; NumPy is used instead
+     njit = None
+
+"""
+Sums every [stride]-th row and column of the HxWxC uint8 image [img].
+
+With Numba available this is a compiled reduction (compiled once and cached on disk)
+that releases the GIL, so the IterDir loader threads can run it side by side;
+otherwise it is the equivalent NumPy expression. Either way the sum is accumulated
+in integers, with no float promotion of the pixels.
+
+Returns:
+     A pair (a, b) where [a] is the sum of the sampled values and [b] is how many were sampled.
+"""
+if njit is not None:
+     @njit(nogil=True, cache=True)
+     def _StridedSum(img, stride):
+          rows = (img.shape[0] + stride - 1) // stride
+          cols = (img.shape[1] + stride - 1) // stride
+          acc = 0
+          for r in range(rows):
+               y = r * stride
+               for c in range(cols):
+                    x = c * stride
+                    for ch in range(img.shape[2]):
+                         acc += img[y, x, ch]
+          return acc, rows * cols * img.shape[2]
+else:
+     def _StridedSum(img, stride):
+          sample = img[::stride, ::stride]
+          return int(sample.sum(dtype=np.uint64)), sample.size
+
+"""
+Flags for decoding a full-resolution image; orientation is left as stored, like pcv.readimage.
+"""
+_FULL_DECODE = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+
+"""
+Shared RawData for every collection event that failed to load or was rejected.
+"""
+_INVALID = RawData(valid=False, rgb=None)
+
+"""
+Every how many rows and columns the night check samples a thumbnail (see [DataLoader.GenRaw]).
+"""
+_PROBE_STRIDE = 2
+
+"""
+Reads the image of [meta] with the imread [flags], logging when it can't be opened.
+
+Returns:
+     The BGR uint8 image, or None if it failed to open.
+"""
+def _ReadProbe(meta: MetaData, flags: int):
+     probe = cv2.imread(meta.rgbFile, flags)
+     if probe is None:
+          logger.warning("Failed to open %s!", meta.rgbFile)
+          return None
+     assert probe.dtype == np.uint8 # The whole pipeline works in uint8
+     return probe
+
+"""
+The night check: whether [total], the sum of [count] sampled pixel values, averages at least 50.
+Compared without dividing. Logs [meta]'s image as a night image when it fails.
+"""
+def _IsDay(meta: MetaData, total: int, count: int) -> bool:
+     if total < count * 50:
+          logger.info("%s is a night image!", meta.rgbFile)
+          return False
+     return True
+
 """
 Responsible for reading in collection event data.
 """
@@ -15,39 +93,136 @@ class DataLoader:
      flag within a given DataUnit. In any case, the loaded arrays are placed
      into the returned DataUnit instance.
 
+     Night images are detected from a 1/8-scale thumbnail that libjpeg decodes directly
+     (sampled at every other row and column), so they are rejected without ever paying for
+     a full-resolution decode. Night and day frames are far enough apart in brightness for
+     the thumbnail to classify them the same way as the full image.
+
      Parameters:
           meta - The MetaData representing the collection event raw data to load into a DataUnit.
+          strict - Fully decode first and average over every pixel for the night check instead (for debugging).
      """
-     def GenRaw(meta: MetaData) -> RawData:
-          img, _, _ = pcv.readimage(meta.rgbFile) # Read from disk
-          if np.average(img) < 50: # Check validity
-               print("{} is a night image!".format(meta.rgbFile), file=sys.stderr)
-               return RawData(False, 0)
+     def GenRaw(meta: MetaData, strict: bool = False) -> RawData:
+          # Decoded straight through OpenCV (what pcv.readimage wraps) into a BGR uint8 array
+          probe = _ReadProbe(meta, _FULL_DECODE if strict else cv2.IMREAD_REDUCED_COLOR_8)
+          if probe is None:
+               return _INVALID
+          if not _IsDay(meta, *_StridedSum(probe, 1 if strict else _PROBE_STRIDE)): # Check validity
+               return _INVALID
+          img = probe if strict else cv2.imread(meta.rgbFile, _FULL_DECODE) # Read from disk
           return RawData(True, img) # Valid, non-night entry
 
+     """
+     Batch equivalent of [GenRaw].
+
+     The thumbnails of all of [metas] are decoded first and, when they share a shape (as
+     frames from the same camera do), stacked into one (K, H, W, C) array so the night check
+     for the whole batch is a single NumPy reduction rather than one call per image.
+     Only the images that pass are then decoded at full resolution.
+
+     Parameters:
+          metas - The MetaData of the collection events to load.
+
+     Returns:
+          A list of RawData, one per entry of [metas] and in the same order.
+     """
+     def GenRawBatch(metas: list) -> list:
+          probes = [_ReadProbe(meta, cv2.IMREAD_REDUCED_COLOR_8) for meta in metas]
+          loaded = [i for i, probe in enumerate(probes) if probe is not None]
+          day = [False] * len(metas)
+          if loaded and all(probes[i].shape == probes[loaded[0]].shape for i in loaded):
+               sample = np.stack([probes[i] for i in loaded])[:, ::_PROBE_STRIDE, ::_PROBE_STRIDE]
+               totals = sample.sum(axis=(1, 2, 3), dtype=np.uint64)
+               count = sample[0].size
+               for i, total in zip(loaded, totals.tolist()):
+                    day[i] = _IsDay(metas[i], total, count)
+          else: # Mixed thumbnail sizes can't be stacked
+               for i in loaded:
+                    day[i] = _IsDay(metas[i], *_StridedSum(probes[i], _PROBE_STRIDE))
+          return [RawData(True, cv2.imread(meta.rgbFile, _FULL_DECODE)) if isDay else _INVALID
+                  for meta, isDay in zip(metas, day)]
+
      """
      Scans the directory at [path] for collection event data and processes the findings into
      corresponding pairs of MetaData and DataUnits.
+
+     The DataUnits are loaded lazily, [batch] at a time (see [GenRawBatch]), so only one
+     batch of images needs to be resident rather than the whole directory.
      
      Paramaters:
-          path - Path to the directory of collection event data. Must have a trailing forward-slash.
+          path - Path to the directory of collection event data.
+          batch - Number of images whose night check is done together.
 
      Returns:
-          A list of pairs (a, b) where [a] is the MetaData for a collection event
-          found in the directory [path] and [b] is the corresponding DataUnit that
-          houses the associated, loaded raw data for the metadata in [a].
+          A generator over the valid DataUnits found in the directory [path], in scan order;
+          each DataUnit pairs the MetaData of a collection event with its loaded raw data.
      """
-     def LoadDir(path: str) -> list:
-          jpgs = glob.glob(path + "*.jpg") # Scan directory
-          data = []
+     def LoadDir(path: str, batch: int = 16) -> Iterator[DataUnit]:
+          jpgs = DataLoader.ScanDir(path)
           # TODO Hook up depth image pairs
-          for name in jpgs: # Per collection event raw data entry
-               meta = MetaData(DataLoader.GetTimestamp(name), name) # Make metadata
-               raw = DataLoader.GenRaw(meta)
-               if raw.valid:
-                    data.append(DataUnit(raw, meta)) # Add converted DataUnit
-          return data
+          for start in range(0, len(jpgs), batch):
+               metas = [MetaData(DataLoader.GetTimestamp(name), name) for name in jpgs[start:start + batch]]
+               for meta, raw in zip(metas, DataLoader.GenRawBatch(metas)): # Per collection event raw data entry
+                    if raw.valid:
+                         yield DataUnit(raw, meta) # Hand over converted DataUnit
                
+     """
+     Threaded equivalent of [LoadDir].
+
+     Images are read and decoded on a small pool of background threads (the decoding
+     itself releases the GIL) while the caller works through the DataUnits already yielded,
+     so disk I/O overlaps with processing. At most [depth] units are resident ahead of the caller.
+
+     Paramaters:
+          path - Path to the directory of collection event data.
+          workers - Number of threads decoding images in the background.
+          depth - Maximum number of loaded DataUnits waiting to be consumed.
+
+     Returns:
+          A generator over the valid DataUnits found in the directory [path], in scan order.
+     """
+     def IterDir(path: str, workers: int = 4, depth: int = 8):
+          jpgs = DataLoader.ScanDir(path)
+          pending = deque() # Bounded queue of in-flight loads, oldest first
+          with ThreadPoolExecutor(max_workers=workers) as ex:
+               for name in jpgs:
+                    pending.append(ex.submit(DataLoader.GenUnit, name))
+                    if len(pending) >= depth:
+                         unit = pending.popleft().result()
+                         if unit.raw.valid:
+                              yield unit
+               while pending: # Drain what is left
+                    unit = pending.popleft().result()
+                    if unit.raw.valid:
+                         yield unit
+
+     """
+     Lists the JPG images in the directory at [path].
+
+     Parameters:
+          path - Path to the directory of collection event data.
+
+     Returns:
+          The paths of the JPG files directly inside [path], sorted by name so that
+          every run visits the collection events in the same (chronological) order.
+     """
+     def ScanDir(path: str) -> list:
+          with os.scandir(path) as it:
+               return sorted(e.path for e in it if e.name.endswith(".jpg") and e.is_file())
+
+     """
+     Loads the collection event data for the image at [name] into a DataUnit.
+
+     Parameters:
+          name - Path to the JPG image of the collection event.
+
+     Returns:
+          The DataUnit for the collection event; check [raw.valid] before using it.
+     """
+     def GenUnit(name: str) -> DataUnit:
+          meta = MetaData(DataLoader.GetTimestamp(name), name) # Make metadata
+          return DataUnit(DataLoader.GenRaw(meta), meta)
+
      """
      Extracts the timestamp from the tail-end of a filename.
      
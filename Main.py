@@ -1,3 +1,6 @@
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from plantcv import plantcv as pcv
 from Options import Options
 from Loader import DataLoader
@@ -6,14 +9,6 @@ from Stage import WhiteBalance, ViewportAdjust, BinaryMask, Consolidation, Rigid
 from StageConfig import WhiteBalanceConfig, ViewportAdjustConfig, BinaryMaskConfig, ConsolidationConfig, RigidSegmentationGridConfig, RigidSegmentationCustomConfig, DBSCANSegmentationConfig, PlantAnalysisConfig
 from StageChannel import DoubleImageChannel
 
-##########################################################
-# Data Loading                                           #
-##########################################################
-
-#units_2 = DataLoader.LoadDir("/Users/alex/Desktop/SubII/")
-units_3a = DataLoader.LoadDir("/Users/alex/Desktop/test_3/")
-#units_3b = DataLoader.LoadDir("/Users/alex/Desktop/Moved_3/")
-
 ##########################################################
 # Shared PlantCV Stage Constructions                     #
 ##########################################################
@@ -29,8 +24,11 @@ va = ViewportAdjust(ViewportAdjustConfig(side='top', rotate=1, shift=70))
 # Stage III
 bm = BinaryMask(BinaryMaskConfig(threshold=135, mx=255, obj='light', fill=200, channel='b'))
 
-# Stage VI
-analysis = PlantAnalysis(PlantAnalysisConfig(filetype='csv', outfile='/Users/alex/Desktop/CSV_DATA/DBSCAN/3a/data'))
+# Stage VI (one per pipeline: each run writes all of its results to its own [outfile].csv)
+analysis_2 = PlantAnalysis(PlantAnalysisConfig(filetype='csv', outfile='/Users/alex/Desktop/CSV_DATA/Rigid/2/data'))
+analysis_3a = PlantAnalysis(PlantAnalysisConfig(filetype='csv', outfile='/Users/alex/Desktop/CSV_DATA/Rigid/3a/data'))
+analysis_3b = PlantAnalysis(PlantAnalysisConfig(filetype='csv', outfile='/Users/alex/Desktop/CSV_DATA/Rigid/3b/data'))
+analysis_db = PlantAnalysis(PlantAnalysisConfig(filetype='csv', outfile='/Users/alex/Desktop/CSV_DATA/DBSCAN/3a/data'))
 
 ##########################################################
 #  Rigid Stage Constructions                             #
@@ -57,12 +55,12 @@ segDB = DBSCANSegmentation(DBSCANSegmentationConfig(minClusterSize=5, epsilon=0.
 #  Pipeline Configurations and Constructions             #
 ##########################################################
 
-options = Options() # General options the same
+options = Options.FromEnv() # General options the same
 
 # Rigid Configuration (ideally: const PipelineConfig *const)
-rCfg_2 = PipelineConfig(options, [wb, va, bm, cs_A, rSeg_2, analysis])
-rCfg_3a = PipelineConfig(options, [wb, bm, cs_B, rSeg_3a, analysis])
-rCfg_3b = PipelineConfig(options, [wb, bm, cs_B, rSeg_3b, analysis])
+rCfg_2 = PipelineConfig(options, [wb, va, bm, cs_A, rSeg_2, analysis_2])
+rCfg_3a = PipelineConfig(options, [wb, bm, cs_B, rSeg_3a, analysis_3a])
+rCfg_3b = PipelineConfig(options, [wb, bm, cs_B, rSeg_3b, analysis_3b])
 
 # Pipeline objects
 r_pipe_2 = Pipeline(rCfg_2)        # For Lettuce Trial 1
@@ -70,17 +68,34 @@ r_pipe_3a = Pipeline(rCfg_3a)      # For Lettuce Trial 2 (prior to 4/20)
 r_pipe_3b = Pipeline(rCfg_3b)      # For Lettuce Trial 2 (post 4/20)
 
 # DBSCAN
-dbscanCfg = PipelineConfig(options, [bm, cs_C, segDB, analysis])
+dbscanCfg = PipelineConfig(options, [bm, cs_C, segDB, analysis_db])
 db_pipe = Pipeline(dbscanCfg)      # Suitable for all Trials
 
 ##########################################################
-#  Pipeline Execution                                    #
+#  Data Loading and Pipeline Execution                   #
 ##########################################################
 
-#r_pipe_2.FormatSet(units_2)
-r_pipe_3a.FormatSet(units_3a)
-#r_pipe_3b.FormatSet(units_3b)
-
-#db_pipe.FormatSet(units_2)
-#db_pipe.FormatSet(units_3a)
-#db_pipe.FormatSet(units_3b)
\ No newline at end of file
+# Guarded so that the worker processes spawned by FormatSet don't re-run this script
+if __name__ == "__main__":
+    # Progress and night-image reports only while debugging
+    logging.basicConfig(level=logging.INFO if options.debug else logging.WARNING, format="%(message)s")
+    # Records are written out by a listener thread, so logging never blocks the stages
+    logQueue = queue.SimpleQueue()
+    listener = QueueListener(logQueue, *logging.getLogger().handlers, respect_handler_level=True)
+    logging.getLogger().handlers = [QueueHandler(logQueue)]
+    listener.start()
+
+    # IterDir loads lazily and can only be consumed once, so every FormatSet gets its own
+    #dir_2 = "/Users/alex/Desktop/SubII/"
+    dir_3a = "/Users/alex/Desktop/test_3/"
+    #dir_3b = "/Users/alex/Desktop/Moved_3/"
+
+    #r_pipe_2.FormatSet(DataLoader.IterDir(dir_2))
+    r_pipe_3a.FormatSet(DataLoader.IterDir(dir_3a))
+    #r_pipe_3b.FormatSet(DataLoader.IterDir(dir_3b))
+
+    #db_pipe.FormatSet(DataLoader.IterDir(dir_2))
+    #db_pipe.FormatSet(DataLoader.IterDir(dir_3a))
+    #db_pipe.FormatSet(DataLoader.IterDir(dir_3b))
+
+    listener.stop() # Write out whatever is still queued
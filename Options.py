@@ -1,13 +1,46 @@
-from typing import NamedTuple
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+"""
+Parses a boolean environment variable, accepting the usual spellings of true.
+"""
+def _EnvBool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
 
 """
 Represnts a configuration for the application.
+
+Fields left as None are unset; see [FromEnv] for a fully populated configuration.
 """
-class Options(NamedTuple):
-    image: str = "/Users/alex/Desktop/pipeline/images/image_2023-02-13 16_52_27.jpg"
-    segname: str = "image_pid_"
-    debug: str = "plot"
-    visualize: bool = True
-    writeimg: bool = True
-    result: str = "multi_plant_tutorial_results_ffp.csv"
-    outdir: str = "./"
\ No newline at end of file
+@dataclass(frozen=True, slots=True)
+class Options:
+    image: Optional[str] = None
+    segname: Optional[str] = None
+    debug: Optional[str] = None
+    visualize: Optional[bool] = None
+    writeimg: Optional[bool] = None
+    result: Optional[str] = None
+    outdir: Optional[str] = None
+
+    """
+    Builds the configuration from PIPE_* environment variables (PIPE_IMAGE, PIPE_SEGNAME,
+    PIPE_DEBUG, PIPE_VISUALIZE, PIPE_WRITEIMG, PIPE_RESULT, PIPE_OUTDIR), so it can be
+    changed between runs without editing source.
+
+    Returns:
+        An Options instance, using the historical defaults for anything not set. There is
+        no sensible default input image, so [image] stays None unless PIPE_IMAGE is set.
+    """
+    @classmethod
+    def FromEnv(cls) -> "Options":
+        return cls(image=os.environ.get("PIPE_IMAGE"),
+                   segname=os.environ.get("PIPE_SEGNAME", "image_pid_"),
+                   debug=os.environ.get("PIPE_DEBUG", "plot"),
+                   visualize=_EnvBool("PIPE_VISUALIZE", True),
+                   writeimg=_EnvBool("PIPE_WRITEIMG", True),
+                   result=os.environ.get("PIPE_RESULT", "multi_plant_tutorial_results_ffp.csv"),
+                   outdir=os.environ.get("PIPE_OUTDIR", "./"))
@@ -1,11 +1,25 @@
+import os
+import cv2
+import functools
+import logging
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from collections.abc import Sized
+from concurrent.futures import ProcessPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
 from sys import stderr
-from typing import NamedTuple, cast
+from dataclasses import dataclass
+from typing import Iterable, Optional, cast
 from plantcv import plantcv as pcv
 from DataTypes import DataUnit, FormattedData
 from Options import Options
-from Stage import Consolidation
+from Stage import Consolidation, SetNumThreads
 from StageChannel import SingleImageChannel, SnapshotChannel, DoubleImageChannel, SegmentationChannel
 
+logger = logging.getLogger(__name__)
+
 """
 A struct that represents a single Pipeline.
 
@@ -14,7 +28,8 @@ while running the pipeline itself, such as debug mode or previewing
 intermiediate graphs, as well as what processing stages make up
 this particular pipeline.
 """
-class PipelineConfig(NamedTuple):
+@dataclass(frozen=True, slots=True)
+class PipelineConfig:
      """General application operating procedures while running the Pipeline."""
      options: Options
 
@@ -39,24 +54,82 @@ class Pipeline(object):
         what constitutes a valid configuration.
      """
      def __init__(self, cfg: PipelineConfig):
-        if not self.IsCompatible(cfg.stages):
+        self.cfg = cfg # PipelineConfig
+        self._Prepare()
+        if not self.IsCompatible(self._ifaceIds):
             print("This pipeline configuration is incompatible!", file=stderr)
             exit(2)
-        self.cfg = cfg # PipelineConfig
 
      """
-     
+     Precomputes the per-stage lookups used by [Format] from the configuration.
+
+     Stage interfaces are fixed once the stages are constructed, so they are only
+     queried here rather than once per stage per DataUnit.
+     """
+     def _Prepare(self):
+        self._ifaceIds = tuple(s.GetInterfaceIDs() for s in self.cfg.stages)
+        self._needsSnapshot = tuple(ids[0] == SnapshotChannel.CHANNEL_ID for ids in self._ifaceIds)
+        self._run = self._Compile()
+
+     """
+     Generates the straight-line equivalent of running every stage in turn.
+
+     The stage sequence never changes after construction, so instead of looping over the
+     stages (and branching on their interfaces) for every DataUnit, one line per stage call
+     is emitted into a function once, with the SnapshotChannel packaging already resolved.
+
+     Returns:
+        A function that takes a valid DataUnit and returns the outputs of every stage,
+        keyed by stage name (see [FormattedData.proc]).
+     """
+     def _Compile(self):
+        src = ["def _run(data):",
+               "    intmed = {'Disk': data}", # Output channels throughout, keyed by stage name (in pipeline order)
+               "    inData = SingleImageChannel(data.raw.rgb)"]
+        scope = {"SingleImageChannel": SingleImageChannel, "SnapshotChannel": SnapshotChannel}
+        for i, (stage, needsSnap) in enumerate(zip(self.cfg.stages, self._needsSnapshot)):
+            scope["invoke%d" % i] = stage.Invoke
+            if needsSnap:
+                src.append("    inData = SnapshotChannel(intmed)")
+            # Output channel of each stage is the input channel for the next
+            src.append("    name, inData = invoke%d(inData)" % i)
+            src.append("    intmed[name] = inData")
+        src.append("    return intmed")
+        exec("\n".join(src), scope)
+        return scope["_run"]
+
+     """
+     Pickling support so that a Pipeline can be shipped to worker processes.
+
+     Only the configuration is sent across; everything else is derived from it.
      """
-     def IsCompatible(self, stages: list) -> bool:
-         curr = stages[0]
-         cIds = curr.GetInterfaceIDs()
-         for i in range(1, len(stages)):
-             nxt = stages[i]
-             nIds = nxt.GetInterfaceIDs()
+     def __getstate__(self) -> dict:
+        return {"cfg": self.cfg}
+
+     def __setstate__(self, state: dict):
+        self.cfg = state["cfg"]
+        self._Prepare()
+
+     """
+     Determines whether a sequence of stages can be chained together.
+
+     Parameters:
+        ifaceIds - The (input, output) interface ID pairs of each stage, in pipeline order.
+
+     Returns:
+        True if every stage either accepts the output channel of the stage before
+        it or takes a SnapshotChannel; False otherwise.
+
+     Note:
+        The result depends only on [ifaceIds], so it is memoized; Pipelines built from
+        the same stage layout are only validated once.
+     """
+     @staticmethod
+     @functools.lru_cache(maxsize=None)
+     def IsCompatible(ifaceIds: tuple) -> bool:
+         for cIds, nIds in zip(ifaceIds, ifaceIds[1:]):
              if (nIds[0] != SnapshotChannel.CHANNEL_ID and cIds[1] != nIds[0]):
                 return False
-             curr = nxt
-             cIds = curr.GetInterfaceIDs()
          return True
        
      """
@@ -69,43 +142,251 @@ class Pipeline(object):
      Returns:
         The FormattedData equivalent for the [data] DataUnit after
         being passed through this Pipeline with the current configuration.
+
+     Note:
+        Stages that gather results across a run (see [Stage.Flush]) are not flushed here, so
+        a PlantAnalysis with the CSV filetype writes nothing for a DataUnit formatted on its
+        own; use [FormatSet] (or [PipelineRunner.Run]), or call Flush on the stages yourself.
      """
      def Format(self, data: DataUnit) -> FormattedData:
-        print("Processing ", data.meta.rgbFile)
+        logger.debug("Processing %s", data.meta.rgbFile)
         if not data.raw.valid:
             return 0
-        inData = SingleImageChannel(data.raw.rgb)
-        intmed = [("Disk", data)] # Used to keep track of Output channels throughout
-        for stage in self.cfg.stages:
-            if stage.GetInterfaceIDs()[0] == SnapshotChannel.CHANNEL_ID:
-                inData = SnapshotChannel(intmed)
-            out = stage.Invoke(inData)
-            intmed.append(out)
-            inData = out[1] # Output channel this iteration is input channel for the next
-        return FormattedData(base=data.raw, proc=intmed)
+        return FormattedData(base=data.raw, proc=self._run(data))
         
      """
      List equivalent of [Format].
+
+     The DataUnits are formatted in parallel, one worker process per CPU core by default;
+     the order of the returned list still matches that of [data]. [data] may also
+     be a generator (see [DataLoader.LoadDir]), in which case only a couple of units
+     per worker are pulled from it ahead of the results being collected. Each worker
+     receives this Pipeline once, when it starts, rather than with every DataUnit.
+     With a single worker the DataUnits are formatted in this process instead, so that
+     PlantCV's debug plotting (pcv.params.debug) works.
      
      Parameters:
-        data - A list of DataUnit instances to process with
+        data - A list (or other iterable) of DataUnit instances to process with
         the configuration assigned to this pipeline in the 
         constructor.
+        total - The number of DataUnits in [data], if known; only used for
+        progress reporting and presizing. Taken from len(data) when omitted.
+        workers - The number of worker processes; defaults to the number of CPU cores.
         
      Returns:
         A list of FormattedData objects that represent the
         evolution of the initial DataUnit's RawData entry over
         the course of the pipeline. Note that each FormattedData
-        instance contains multiple StageEntry instances, so there
+        instance holds the outputs of every Stage (a StageEntry), so there
         is a 1-to-1 correlation between a DataUnit and an entry
         in the returned list.
      """
-     def FormatSet(self, data: list) -> list:
+     def FormatSet(self, data: Iterable[DataUnit], total: Optional[int] = None, workers: Optional[int] = None) -> list:
+        if total is None and isinstance(data, Sized):
+            total = len(data)
+        done = [None] * total if total is not None else [] # Presized whenever the count is known
+        workers = workers or os.cpu_count()
+        count = 0
+        if workers == 1: # Serial, in this process
+            for fmt in map(self.Format, data):
+                count = self._Collect(done, count, fmt, total)
+        else:
+            # Workers hand their log records to this process, which alone writes them out
+            logQueue = multiprocessing.Queue()
+            listener = QueueListener(logQueue, *logging.getLogger().handlers, respect_handler_level=True)
+            listener.start()
+            try:
+                # Each DataUnit is independent, so spread them over a pool of worker processes
+                with ProcessPoolExecutor(max_workers=workers, initializer=_InitWorker,
+                                         initargs=(self, logQueue, logging.getLogger().getEffectiveLevel())) as ex:
+                    for fmt in _MapOrdered(ex, _FormatOne, data, depth=2 * workers):
+                        count = self._Collect(done, count, fmt, total)
+            finally:
+                listener.stop()
+        del done[count:] # In case [total] overestimated
+        if count == 0: # Nothing to flush; don't replace the results of an earlier run
+            logger.warning("No DataUnits to format; was the loader already consumed?")
+            return done
+        for stage in self.cfg.stages: # Results gathered across the whole set
+            stage.Flush(done)
+        return done
+
+     """
+     Stores [fmt], the [count]-th result of [FormatSet], into [done].
+
+     Returns:
+        The number of results stored so far.
+     """
+     def _Collect(self, done: list, count: int, fmt, total: Optional[int]) -> int:
+        logger.info("Formatted image %d of %s ...", count, "?" if total is None else total - 1)
+        # TODO Error condition invalid data
+        if count < len(done):
+            done[count] = fmt
+        else:
+            done.append(fmt)
+        return count + 1
+
+"""
+Runs a Pipeline over a stream of DataUnits with every stage working at the same time.
+
+Each stage gets its own thread, and consecutive stages are linked by small bounded
+queues, so while one image is in (say) the segmentation stage the next is already being
+white balanced. Throughput is then bounded by the slowest stage rather than the sum of
+all of them; the OpenCV calls at the heart of each stage release the GIL, which is what
+lets the threads overlap. Every stage still sees the images one at a time and in order.
+"""
+class PipelineRunner(object):
+     """
+     Parameters:
+        pipeline - The Pipeline whose stages are to be run.
+        depth - Maximum number of images waiting between any two stages.
+     """
+     def __init__(self, pipeline: Pipeline, depth: int = 2):
+        self.pipeline = pipeline
+        self.depth = depth
+
+     """
+     Threaded equivalent of [Pipeline.FormatSet].
+
+     Parameters:
+        data - A list (or other iterable) of DataUnit instances to process.
+
+     Returns:
+        A list of FormattedData objects in the order of [data] (0 for invalid DataUnits),
+        as with [Pipeline.FormatSet].
+
+     Note:
+        An exception raised by a stage stops the feeding of new images and is re-raised
+        here once the images already in flight have drained.
+     """
+     def Run(self, data: Iterable[DataUnit]) -> list:
+        stages = self.pipeline.cfg.stages
+        queues = [queue.Queue(maxsize=self.depth) for _ in range(len(stages) + 1)]
+        abort = threading.Event()
+        threads = [threading.Thread(target=_Feed, args=(data, queues[0], abort), daemon=True)]
+        for i, (stage, needsSnap) in enumerate(zip(stages, self.pipeline._needsSnapshot)):
+            threads.append(threading.Thread(target=_RunStage, args=(stage, needsSnap, queues[i], queues[i + 1]), daemon=True))
+        for t in threads:
+            t.start()
         done = []
-        i = 0
-        for unit in data:
-            print("Loading image", i, "of", len(data) - 1, "...")
-            i = i + 1
-            # TODO Error condition invalid data
-            done.append(self.Format(unit))
+        error = None
+        while True:
+            item = queues[-1].get()
+            if item is _STOP:
+                break
+            if isinstance(item, BaseException):
+                if error is None:
+                    error = item
+                    abort.set()
+                continue
+            unit, intmed, _ = item
+            logger.info("Formatted image %d ...", len(done))
+            done.append(0 if intmed is None else FormattedData(base=unit.raw, proc=intmed))
+        for t in threads:
+            t.join()
+        if error is not None:
+            raise error
+        if not done: # Nothing to flush; don't replace the results of an earlier run
+            logger.warning("No DataUnits to format; was the loader already consumed?")
+            return done
+        for stage in stages: # Results gathered across the whole set
+            stage.Flush(done)
         return done
+
+"""
+The Pipeline a FormatSet worker process runs; set once by [_InitWorker].
+"""
+_workerPipeline = None
+
+"""
+Sets up a FormatSet worker process.
+
+The worker keeps its own copy of [pipeline] for its whole life, so the Pipeline is only
+shipped (and prepared, see [Pipeline._Prepare]) once per worker, and whatever its stages
+cache carries over from one DataUnit to the next. Parallelism already comes from running
+one worker per core, so OpenCV's thread pool and the Stages' own (see [Stage.SetNumThreads])
+are limited to a single thread to avoid oversubscribing the CPU. Log records are forwarded to the parent process through
+[logQueue] rather than written from every worker.
+
+Parameters:
+    pipeline - The Pipeline to format DataUnits with (see [_FormatOne]).
+    logQueue - The queue the parent process is listening to for log records.
+    level - The logging level of the parent process.
+"""
+def _InitWorker(pipeline: Pipeline, logQueue, level: int):
+    global _workerPipeline
+    _workerPipeline = pipeline
+    cv2.setNumThreads(1)
+    SetNumThreads(1)
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(logQueue)]
+    root.setLevel(level)
+
+"""
+Formats [unit] with the Pipeline of this FormatSet worker process (see [Pipeline.Format]).
+"""
+def _FormatOne(unit: DataUnit) -> FormattedData:
+    return _workerPipeline.Format(unit)
+
+"""
+Lazily maps [fn] over [items] on the executor [ex], keeping at most [depth] calls in flight.
+
+Unlike [Executor.map], [items] is only consumed as results are collected, so a generator
+of images is never drained up front. Results are yielded in the order of [items].
+"""
+def _MapOrdered(ex, fn, items: Iterable, depth: int):
+    pending = deque() # In-flight calls, oldest first
+    for item in items:
+        pending.append(ex.submit(fn, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending: # Drain what is left
+        yield pending.popleft().result()
+
+"""
+Marks the end of the stream passed between PipelineRunner threads.
+"""
+_STOP = object()
+
+"""
+PipelineRunner thread that turns the DataUnits of [data] into work items for the first stage.
+
+Each item is a (DataUnit, intermediates, input channel) triple, laid out as in [Pipeline._Compile];
+invalid DataUnits are sent with no intermediates, so they pass through every stage untouched and
+keep their place in the output. Stops early once [abort] is set.
+"""
+def _Feed(data: Iterable[DataUnit], outQ: queue.Queue, abort: threading.Event):
+    try:
+        for unit in data:
+            if abort.is_set():
+                break
+            if unit.raw.valid:
+                logger.debug("Processing %s", unit.meta.rgbFile)
+                outQ.put((unit, {'Disk': unit}, SingleImageChannel(unit.raw.rgb)))
+            else:
+                outQ.put((unit, None, None))
+    except Exception as e: # Reading the data failed; report it downstream
+        outQ.put(e)
+    outQ.put(_STOP)
+
+"""
+PipelineRunner thread that applies [stage] to every work item from [inQ] and passes it on to [outQ].
+
+Exceptions (raised here or upstream) are forwarded in place of the work item.
+"""
+def _RunStage(stage, needsSnap: bool, inQ: queue.Queue, outQ: queue.Queue):
+    while True:
+        item = inQ.get()
+        if item is not _STOP and not isinstance(item, BaseException) and item[1] is not None:
+            unit, intmed, inData = item
+            try:
+                if needsSnap:
+                    inData = SnapshotChannel(intmed)
+                name, inData = stage.Invoke(inData)
+                intmed[name] = inData
+                item = (unit, intmed, inData)
+            except Exception as e:
+                item = e
+        outQ.put(item)
+        if item is _STOP:
+            return
@@ -1,9 +1,411 @@
-import pandas as pd
+import os
+import csv
+import cv2
+import logging
+import threading
+import weakref
 import numpy as np
 from plantcv import plantcv as pcv
+from collections import OrderedDict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from typing import cast
-from StageConfig import StageConfig, WhiteBalanceConfig, ViewportAdjustConfig, BinaryMaskConfig, RigidSegmentationConfig, RigidSegmentationGridConfig, RigidSegmentationCustomConfig, DBSCANSegmentationConfig, PlantAnalysisConfig, ConsolidationConfig
-from StageChannel import StageChannel, SingleImageChannel, DoubleImageChannel, SegmentationChannel, SnapshotChannel
+from StageConfig import StageConfig, WhiteBalanceConfig, ViewportAdjustConfig, BinaryMaskConfig, RigidSegmentationConfig, DBSCANSegmentationConfig, PlantAnalysisConfig, ConsolidationConfig
+from StageChannel import StageChannel, SingleImageChannel, DoubleImageChannel, SegmentationChannel, SnapshotChannel, ResultsChannel
+
+logger = logging.getLogger(__name__)
+
+try:
+    from numba import njit
+except ImportError: # Numba is optional; the OpenCV/PlantCV calls are used instead
+    njit = None
+
+"""
+Threads shared by every Stage for work within a single image (see [_Map]); created on first use.
+"""
+_numThreads = os.cpu_count()
+_pool = None
+_POOL_LOCK = threading.Lock()
+
+"""
+Sets how many threads the Stages may use for work within a single image.
+
+Must be called before any Stage runs. With 1 (as in FormatSet's worker processes, which
+already run one per core) that work is done serially in the calling thread.
+"""
+def SetNumThreads(n: int):
+    global _numThreads
+    _numThreads = max(int(n), 1)
+
+"""
+Calls [fn] on every element of [items], on the shared thread pool when it has more than one
+thread, and returns the results in order. Any exception raised by [fn] is raised here.
+"""
+def _Map(fn, items) -> list:
+    global _pool
+    if _numThreads <= 1:
+        return list(map(fn, items))
+    with _POOL_LOCK:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=_numThreads)
+    return list(_pool.map(fn, items))
+
+"""
+Index of each channel accepted by pcv.rgb2gray_lab within an OpenCV LAB image.
+"""
+_LAB_CHANNELS = {"l": 0, "a": 1, "b": 2}
+
+"""
+Most recently used LAB conversions, keyed by (id, shape) of the BGR image they came from.
+
+Off (size 0) unless turned on with [SetLabCacheSize]: a normal run converts every image exactly
+once, and as FormatSet and PipelineRunner keep every image of the run alive, the cache would only
+pin up to its size in LAB images. Each entry holds a weak reference to its source image and is
+dropped once that image is freed, so an id reused by a new array can't produce a stale hit.
+Guarded by a lock since PipelineRunner and the segmentation pool call in from threads.
+"""
+_LAB_CACHE = OrderedDict()
+_labCacheSize = 0
+_LAB_CACHE_LOCK = threading.RLock() # Re-entrant, as the eviction callback can run during a GC in this thread
+
+"""
+Sets how many LAB conversions [_LabImage] keeps for reuse; 0 (the default) turns the cache off.
+
+Worth turning on when the same images are run through BinaryMask repeatedly, e.g. when sweeping
+its threshold, so that each image is only converted once. Cached images must not be modified in
+place afterwards.
+"""
+def SetLabCacheSize(n: int):
+    global _labCacheSize
+    with _LAB_CACHE_LOCK:
+        _labCacheSize = max(int(n), 0)
+        while len(_LAB_CACHE) > _labCacheSize:
+            _LAB_CACHE.popitem(last=False)
+
+"""
+Converts the BGR image [img] to LAB, reusing the conversion if [img] was converted before
+and the cache is on (see [SetLabCacheSize]).
+
+Returns:
+    The 3-channel uint8 LAB image; shared, so it must not be modified either.
+"""
+def _LabImage(img: np.ndarray) -> np.ndarray:
+    if _labCacheSize == 0:
+        return _LabConvert(img)
+    key = (id(img), img.shape)
+    with _LAB_CACHE_LOCK:
+        hit = _LAB_CACHE.get(key)
+        if hit is not None and hit[0]() is img:
+            _LAB_CACHE.move_to_end(key)
+            return hit[1]
+    lab = _LabConvert(img)
+    def Evict(ref):
+        with _LAB_CACHE_LOCK:
+            entry = _LAB_CACHE.get(key)
+            if entry is not None and entry[0] is ref:
+                del _LAB_CACHE[key]
+    with _LAB_CACHE_LOCK:
+        _LAB_CACHE[key] = (weakref.ref(img, Evict), lab)
+        _LAB_CACHE.move_to_end(key)
+        while len(_LAB_CACHE) > _labCacheSize:
+            _LAB_CACHE.popitem(last=False)
+    return lab
+
+"""
+Converts the BGR image [img] to LAB, without caching.
+"""
+def _LabConvert(img: np.ndarray) -> np.ndarray:
+    return cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+
+"""
+Equivalent of pcv.rgb2gray_lab that only materializes the requested LAB plane.
+
+pcv.rgb2gray_lab splits the full LAB image into three planes to return one of them;
+extracting just the plane in use writes a third of the bytes.
+
+Parameters:
+    img - The BGR image to convert.
+    channel - One of 'l', 'a', or 'b'.
+
+Returns:
+    The requested LAB channel as a contiguous, single-channel uint8 image.
+"""
+def _LabChannel(img: np.ndarray, channel: str) -> np.ndarray:
+    idx = _LAB_CHANNELS.get(channel.lower())
+    if idx is None:
+        pcv.fatal_error("Channel " + str(channel) + " is not l, a or b!")
+    return cv2.extractChannel(_LabImage(img), idx)
+
+"""
+Writes [hi] wherever channel [idx] of the 3-channel uint8 image [src] is above [thr] and [lo]
+everywhere else, into the single-channel uint8 image [out].
+
+This is the LAB channel extraction and the threshold fused into one pass; the plane itself is
+never materialized. The compiled loop releases the GIL, like the OpenCV calls it stands in for.
+"""
+if njit is not None:
+    @njit(nogil=True, cache=True)
+    def _PlaneThreshold(src, idx, thr, hi, lo, out):
+        for y in range(src.shape[0]):
+            for x in range(src.shape[1]):
+                out[y, x] = hi if src[y, x, idx] > thr else lo
+
+"""
+Mask tests of RigidSegmentation's ROI workers, on equally sized single-channel uint8 images.
+
+[_Overlaps] tells whether [a] and [b] are both set at any pixel, stopping at the first such
+pixel; [_Erase] clears [img] wherever [fill] is set. With Numba available these are compiled
+loops that release the GIL, so the ROI threads don't take turns on them, and neither allocates
+a temporary; otherwise they are the equivalent NumPy expressions.
+"""
+if njit is not None:
+    @njit(nogil=True, cache=True)
+    def _Overlaps(a, b):
+        for y in range(a.shape[0]):
+            for x in range(a.shape[1]):
+                if a[y, x] != 0 and b[y, x] != 0:
+                    return True
+        return False
+
+    @njit(nogil=True, cache=True)
+    def _Erase(fill, img):
+        for y in range(fill.shape[0]):
+            for x in range(fill.shape[1]):
+                if fill[y, x] != 0:
+                    img[y, x] = 0
+else:
+    def _Overlaps(a, b):
+        return bool(np.any(a & b))
+
+    def _Erase(fill, img):
+        img[fill > 0] = 0
+
+"""
+Equivalent of pcv.threshold.binary applied to _LabChannel(img, channel).
+
+With Numba available the LAB image is thresholded in place of extracting the plane first
+(see [_PlaneThreshold]); otherwise the extracted plane goes through a single NumPy
+comparison. Either way the LAB conversion itself is left to OpenCV, since reproducing
+its fixed-point arithmetic by hand would not be bit-exact. Like cv2.THRESH_BINARY, a pixel
+is set when it is strictly above [threshold] ("light"), or at or below it ("dark").
+
+Parameters:
+    img - The BGR image to convert.
+    channel - One of 'l', 'a', or 'b'.
+    threshold - Threshold value (0-255).
+    mx - Value given to the selected pixels.
+    obj - "light" or "dark".
+
+Returns:
+    The binary uint8 mask.
+"""
+def _LabThreshold(img: np.ndarray, channel: str, threshold, mx, obj: str) -> np.ndarray:
+    if obj.upper() not in ("LIGHT", "DARK"):
+        pcv.fatal_error('Object type ' + str(obj) + ' is not "light" or "dark"!')
+    mx = int(min(max(round(mx), 0), 255)) # As OpenCV saturates it for uint8
+    hi, lo = (mx, 0) if obj.upper() == "LIGHT" else (0, mx)
+    if njit is None: # Plain NumPy comparison and select, no pcv/OpenCV dispatch
+        above = _LabChannel(img, channel) > int(np.floor(threshold))
+        return np.where(above, np.uint8(hi), np.uint8(lo))
+    idx = _LAB_CHANNELS.get(channel.lower())
+    if idx is None:
+        pcv.fatal_error("Channel " + str(channel) + " is not l, a or b!")
+    out = np.empty(img.shape[:2], dtype=np.uint8)
+    _PlaneThreshold(_LabImage(img), idx, int(np.floor(threshold)), np.uint8(hi), np.uint8(lo), out)
+    return out
+
+"""
+Equivalent of pcv.fill(mask, size) for the binary masks produced by [_LabThreshold].
+
+PlantCV goes through skimage's remove_small_objects (a scipy labelling, a bincount and a
+boolean scatter); here OpenCV labels the 4-connected components and reports their areas in
+one pass, and the kept labels are mapped straight to 0/255 through a lookup table. As with
+PlantCV, components of fewer than [size] pixels are removed. The input is not re-checked for
+being binary, since [_LabThreshold] only ever produces two values.
+
+Parameters:
+    mask - The binary uint8 mask.
+    size - Minimum area, in pixels, of the components to keep.
+
+Returns:
+    The filtered mask, with kept pixels at 255.
+"""
+def _Fill(mask: np.ndarray, size: int) -> np.ndarray:
+    n, labels, stats, _ = cv2.connectedComponentsWithStats((mask != 0).view(np.uint8), connectivity=4, ltype=cv2.CV_32S)
+    keep = np.where(stats[:, cv2.CC_STAT_AREA] >= size, np.uint8(255), np.uint8(0))
+    keep[0] = 0 # Background
+    return keep[labels]
+
+"""
+Flattens [observations] (see pcv.outputs) into (sample, trait, value, label) rows, exactly as
+pcv.outputs.save_results does for CSV: list and tuple values get one row per element (nested
+tuples are skipped) and booleans are stored as 1/0.
+"""
+def _ObservationRows(observations: dict):
+    for sample, traits in observations.items():
+        for var, obs in traits.items():
+            val = obs["value"]
+            if isinstance(val, (list, tuple)):
+                for value, label in zip(val, obs["label"]):
+                    if not isinstance(value, tuple):
+                        yield (sample, var, value, label)
+            elif isinstance(val, bool):
+                yield (sample, var, int(val), obs["label"])
+            else:
+                yield (sample, var, val, obs["label"])
+
+"""
+Formats a CSV value the way pandas wrote back the (all numeric) value column after reading it:
+as a float, with NaN left empty. Non-numeric values are written as they are.
+"""
+def _CsvNumber(value) -> str:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return "" if value != value else str(value)
+
+"""
+Formats a CSV label, leaving empty the strings pandas would have read back as missing.
+"""
+def _CsvText(value) -> str:
+    value = str(value)
+    return "" if value in ("", "None", "NaN", "nan", "NA", "N/A", "NULL", "null", "n/a") else value
+
+"""
+Equivalent of the cluster masks returned by pcv.spatial_clustering(mask, "DBSCAN", minClusterSize, epsilon).
+
+Parameters:
+    mask - The binary mask whose white (255) pixels are to be clustered.
+    minClusterSize - Minimum number of pixels in a cluster (DBSCAN's min_samples).
+    epsilon - Maximum distance between two neighboring pixels, in standardized coordinates.
+
+Returns:
+    A list of binary masks, one per cluster.
+"""
+def _SpatialClustering(mask: np.ndarray, minClusterSize: int, epsilon: float) -> list:
+    _, masks = pcv.spatial_clustering(mask=mask, algorithm="DBSCAN", min_cluster_size=minClusterSize, max_distance=epsilon)
+    return masks
+
+"""
+Splits each of the cluster masks [masks] (see [_SpatialClustering]) for as long as clustering it
+again still finds more than one cluster in it.
+
+The clusters are worked through depth-first with an explicit stack rather than by recursion.
+A mask is kept once clustering it again finds exactly one cluster; a mask with fewer than
+[minClusterSize] pixels can't hold a cluster, so it is dropped without clustering it again
+(clustering would find nothing in it either).
+
+Note:
+    Not yet part of DBSCANSegmentation, which keeps the clusters of the first clustering as is.
+
+Parameters:
+    masks - The binary masks of the clusters found so far.
+    minClusterSize - The minimum number of pixels in a cluster.
+    epsilon - The DBSCAN neighbourhood radius.
+
+Returns:
+    The masks of the clusters that could not be split any further, in the order they were found.
+"""
+def _RefineClusters(masks: list, minClusterSize: int, epsilon: float) -> list:
+    refined = []
+    stack = list(reversed(masks)) # Depth-first, in the order the clusters were found
+    while stack:
+        mask = stack.pop()
+        if cv2.countNonZero(mask) < minClusterSize:
+            continue
+        sbMsks = _SpatialClustering(mask, minClusterSize, epsilon)
+        if len(sbMsks) == 1:
+            refined.append(mask) # Best one can get with these hyperparameters
+        else:
+            stack.extend(reversed(sbMsks))
+    return refined
+
+"""
+Equivalent of pcv.white_balance(img, mode="hist", roi=roi) for uint8 images.
+
+PlantCV scales each channel by 255 over the top of its ROI histogram (the ROI maximum, or half
+a level above it when the ROI is flat) through a full-size float intermediate per channel. For
+uint8 data that mapping only has 256 possible inputs, so it is evaluated once per level, with
+PlantCV's exact expression, and then applied to the image as a per-channel lookup table by
+cv2.LUT in a single native pass.
+
+Parameters:
+    img - The BGR (or single-channel) uint8 image to correct.
+    roi - (x, y, width, height) of the white reference in the image, or None for the whole image.
+
+Returns:
+    The corrected image.
+"""
+def _WhiteBalance(img: np.ndarray, roi) -> np.ndarray:
+    if roi is not None:
+        if len(roi) != 4 or not all(isinstance(item, (list, int)) for item in roi):
+            pcv.fatal_error('If ROI is used ROI must have 4 elements as a list and all must be integers')
+        x, y, w, h = roi
+    else:
+        x, y, w, h = 0, 0, img.shape[1], img.shape[0]
+    ref = img[y:y + h, x:x + w].reshape(-1, 1 if img.ndim == 2 else img.shape[2])
+    levels = np.arange(256, dtype=np.uint8)
+    luts = []
+    for c in range(0, ref.shape[1]):
+        if ref.shape[0] == 0:
+            max1 = 1.0 # Top bin edge np.histogram gives an empty ROI
+        else:
+            lo, hi = int(ref[:, c].min()), int(ref[:, c].max())
+            max1 = hi if lo < hi else hi + 0.5 # np.histogram widens a flat range by half a level
+        alpha = 255 / float(max1)
+        luts.append(np.asarray(np.where(levels <= max1, np.multiply(alpha, levels), 255), np.uint8))
+    lut = np.dstack(luts) if len(luts) > 1 else luts[0]
+    return cv2.LUT(img, lut.reshape(1, 256, -1))
+
+"""
+Equivalent of pcv.shift_img(pcv.rotate(img, deg, crop=False), number, side).
+
+The rotated image is written straight into place in the output with a single cv2.warpAffine
+for a "top" shift, so the image is only resampled and written once; for the other sides the
+rotated image is moved over with one copy instead of pcv.shift_img's stacking. Folding the
+shift into the affine matrix instead would change the rounding of OpenCV's fixed-point
+sampling, and with it a handful of pixels.
+
+Parameters:
+    img - The image to rotate.
+    deg - The amount in degrees to rotate the image by (counterclockwise, as pcv.rotate).
+    number - One more than the number of pixels to shift the rotated image by (as pcv.shift_img).
+    side - One of 'top', 'bottom', 'left', 'right'; the side the (black) gap opens on.
+
+Returns:
+    The rotated, shifted image, the size of the rotated image's bounding box.
+"""
+def _RotateShift(img: np.ndarray, deg, number: int, side: str) -> np.ndarray:
+    n = number - 1 # pcv.shift_img moves by one pixel less than asked
+    if n < 0:
+        pcv.fatal_error("number cannot be 0, negative numbers, or non-integers")
+    side = side.upper()
+    if side not in ("TOP", "BOTTOM", "LEFT", "RIGHT"):
+        pcv.fatal_error("side must be 'top', 'bottom', 'right', or 'left'")
+    # Rotation about the centre into an uncropped canvas, as pcv.transform.rotate
+    iy, ix = img.shape[:2]
+    m = cv2.getRotationMatrix2D((ix / 2, iy / 2), deg, 1)
+    cos = np.abs(m[0, 0])
+    sin = np.abs(m[0, 1])
+    nw = int((iy * sin) + (ix * cos))
+    nh = int((iy * cos) + (ix * sin))
+    m[0, 2] += (nw / 2) - (ix / 2)
+    m[1, 2] += (nh / 2) - (iy / 2)
+    if n >= (nh if side in ("TOP", "BOTTOM") else nw): # Shifted out entirely; leave the odd shapes to pcv
+        return pcv.shift_img(cv2.warpAffine(img, m, (nw, nh)), number=number, side=side)
+    out = np.zeros((nh, nw) + img.shape[2:], dtype=img.dtype)
+    if side == "TOP":
+        cv2.warpAffine(img, m, (nw, nh - n), dst=out[n:])
+        return out
+    turned = cv2.warpAffine(img, m, (nw, nh))
+    if side == "BOTTOM":
+        out[:nh - n] = turned[n:]
+    elif side == "RIGHT":
+        out[:, :nw - n] = turned[:, n:]
+    else:
+        out[:, n:] = turned[:, :nw - n]
+    return out
 
 """
 Represents an encapsulated processing unit that involves wrapped PlantCV function calls.
@@ -56,6 +458,17 @@ class Stage(object):
     def Invoke(inData: StageChannel) -> tuple:
         pass
 
+    """
+    Finishes off a run of this Stage over a whole set of DataUnits, e.g. by writing out results
+    gathered across it. Does nothing unless overridden.
+
+    Parameters:
+        formatted - The FormattedData produced for each DataUnit of the run, in order (0 for
+                    invalid DataUnits; see [Pipeline.FormatSet]).
+    """
+    def Flush(self, formatted: list):
+        pass
+
 """
 Represents a configurable processing unit that invokes PlantCV calls to produce a white-balanced image.
 
@@ -104,7 +517,7 @@ class WhiteBalance(Stage):
     """
     def Invoke(self, inData: StageChannel) -> tuple:
         wbInput = cast(SingleImageChannel, inData)
-        oImg = pcv.white_balance(wbInput.img, roi=self.cfg.roi)
+        oImg = _WhiteBalance(wbInput.img, self.cfg.roi)
         oChannel = SingleImageChannel(oImg) # Package for next stage
         return (self.GetName(), oChannel)
 
@@ -156,9 +569,7 @@ class ViewportAdjust(Stage):
     """
     def Invoke(self, inData: StageChannel) -> tuple:
         vaInput = cast(SingleImageChannel, inData)
-        pcv.params.verbose = False
-        turned = pcv.rotate(vaInput.img, rotation_deg=self.cfg.rotate, crop=False)
-        oImg = pcv.shift_img(turned, number=self.cfg.shift, side=self.cfg.side)
+        oImg = _RotateShift(vaInput.img, self.cfg.rotate, self.cfg.shift, self.cfg.side)
         oChannel = SingleImageChannel(oImg) # Package for next stage
         return (self.GetName(), oChannel)
 
@@ -212,9 +623,8 @@ class BinaryMask(Stage):
     """
     def Invoke(self, inData: StageChannel) -> tuple:
         bmIn = cast(SingleImageChannel, inData)
-        chan = pcv.rgb2gray_lab(bmIn.img, channel=self.cfg.channel)
-        thre = pcv.threshold.binary(chan, threshold=self.cfg.threshold, max_value=self.cfg.mx, object_type=self.cfg.obj)
-        oImg = pcv.fill(thre, size=self.cfg.fill)
+        thre = _LabThreshold(bmIn.img, self.cfg.channel, self.cfg.threshold, self.cfg.mx, self.cfg.obj)
+        oImg = _Fill(thre, self.cfg.fill)
         oChannel = SingleImageChannel(oImg) # Package for next stage
         return (self.GetName(), oChannel)
 
@@ -251,20 +661,19 @@ class Consolidation(Stage):
         return (SnapshotChannel.CHANNEL_ID, self.cfg.outChannelId)
     
     """
-    Extracts the output from the stage with name [stageName] from the list of StageEntry instances [formatted].
+    Extracts the output from the stage with name [stageName] from the StageEntry mapping [formatted].
 
     Parameters:
         stageName - The string name of the Stage whose output should be collected.
-        formatted - A list of StageEntry instances outputted so far by the pipeline; used for sourcing images.
+        formatted - The outputs of the pipeline so far, keyed by Stage name; used for sourcing images.
     """
     def FindOutput(self, stageName, formatted):
-        for entry in formatted:
-            if entry[0] == stageName:
-                if stageName == "Disk":
-                    return entry[1].raw.rgb
-                else:    
-                    return entry[1].img
-        return 0
+        entry = formatted.get(stageName)
+        if entry is None:
+            return 0
+        if stageName == "Disk":
+            return entry.raw.rgb
+        return entry.img
 
     """
     Runs the RigidSegmentation Stage's processing unit on the given input channel from a previous stage.
@@ -278,12 +687,12 @@ class Consolidation(Stage):
     """
     def Invoke(self, inData: StageChannel) -> tuple:
         csInput = cast(SnapshotChannel, inData)
+        outs = [self.FindOutput(name, csInput.formatted) for name in self.cfg.stageNames[:2]] # Resolved once each
         if self.cfg.outChannelId == SingleImageChannel.CHANNEL_ID:
-            return (self.GetName(), SingleImageChannel(img=self.FindOutput(self.cfg.stageNames[0], csInput.formatted)))
+            return (self.GetName(), SingleImageChannel(img=outs[0]))
         elif self.cfg.outChannelId == DoubleImageChannel.CHANNEL_ID:
-            return (self.GetName(), DoubleImageChannel(imgPrimary=self.FindOutput(self.cfg.stageNames[0], csInput.formatted),
-                                                       imgSecondary=self.FindOutput(self.cfg.stageNames[1], csInput.formatted),
-                                                       tag=csInput.formatted[0][1].meta.rgbFile))
+            return (self.GetName(), DoubleImageChannel(imgPrimary=outs[0], imgSecondary=outs[1],
+                                                       tag=csInput.formatted["Disk"].meta.rgbFile))
 
 """
 Represents a configurable processing unit that invokes PlantCV calls to produce individual masks for each plant.
@@ -332,33 +741,87 @@ class RigidSegmentation(Stage):
     """
     def Invoke(self, inData: StageChannel) -> tuple:
         rsInput = cast(DoubleImageChannel, inData)
-        objs, objH = pcv.find_objects(rsInput.imgPrimary, rsInput.imgSecondary)
         rCfg = cast(RigidSegmentationConfig, self.cfg)
-        if rCfg.GetRigidType() == RigidSegmentationGridConfig.RIGID_TYPE:
-            gCfg = cast(RigidSegmentationGridConfig, rCfg)
-            rois, roiH = pcv.roi.multi(rsInput.imgPrimary, coord=gCfg.start, 
-                                                       radius=gCfg.radius, 
-                                                       spacing=gCfg.spacing, 
-                                                       nrows=gCfg.rows, 
-                                                       ncols=gCfg.cols)
-        elif rCfg.GetRigidType() == RigidSegmentationCustomConfig.RIGID_TYPE:
-            cCfg = cast(RigidSegmentationCustomConfig, self.cfg)
-            rois, roiH = pcv.roi.multi(rsInput.imgPrimary, coord=cCfg.centers, radius=cCfg.radius)
-        oContours = []
-        oMasks = []
-        for i in range(0, len(rois)):
-            xCont, xHier, _, pArea = pcv.roi_objects(rsInput.imgPrimary, 
-                                                     roi_contour=rois[i],
-                                                     roi_hierarchy=roiH[i],
-                                                     object_contour=objs,
-                                                     obj_hierarchy=objH)
-            if pArea <= 0:
-                oContours.append([])
-                oMasks.append([])
-                continue # Go to next plant but recognize that there was no reading
-            pCont, pMask = pcv.object_composition(rsInput.imgPrimary, contours=xCont, hierarchy=xHier)
-            oContours.append(pCont)
-            oMasks.append(pMask)
+        centers = rCfg.GetCenters() # Row-major for a grid, as pcv.roi.multi
+        radius = rCfg.radius
+        mask = rsInput.imgSecondary
+        height, width = mask.shape[:2]
+        if np.any((centers - radius < 0) | (centers + radius > (width, height))):
+            pcv.fatal_error("An ROI extends outside of the image!")
+        centers = centers.tolist() # Plain ints for the OpenCV calls
+        # Every object in the mask is found once, rather than once per ROI (as pcv.find_objects)
+        objs, objH = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[-2:]
+        base = np.zeros((height, width), dtype=np.uint8)
+        if len(objs) > 0:
+            cv2.drawContours(base, objs, -1, (255), -1, lineType=8, hierarchy=objH)
+        rects = np.array([cv2.boundingRect(c) for c in objs], dtype=np.int64).reshape(-1, 4) # x, y, w, h
+        """
+        Fills in object [c] over its own bounding box, by pcv.roi_objects' overlap test ([erase] false)
+        or by its erasure. Filling over the whole box matters: OpenCV rasterizes polygons that get
+        clipped by the edge of the canvas slightly differently.
+        """
+        def Fill(c: int, erase: bool) -> np.ndarray:
+            x, y, w, h = rects[c]
+            fill = np.zeros((h, w), dtype=np.uint8)
+            if erase:
+                cv2.drawContours(fill, objs, int(c), (255), -1, lineType=8, offset=(-int(x), -int(y)))
+            else:
+                cv2.fillPoly(fill, [np.vstack(objs[c])], (255), offset=(-int(x), -int(y)))
+            return fill
+        """
+        The parts of [fill] (the box of object [c], see [Fill]) and of [img] (placed at ([x], [y])) that overlap.
+        """
+        def Clip(c: int, fill: np.ndarray, img: np.ndarray, x: int, y: int) -> tuple:
+            fx, fy = int(rects[c, 0]), int(rects[c, 1])
+            ix0, iy0 = max(fx, x), max(fy, y)
+            ix1, iy1 = min(fx + fill.shape[1], x + img.shape[1]), min(fy + fill.shape[0], y + img.shape[0])
+            return (fill[iy0 - fy:iy1 - fy, ix0 - fx:ix1 - fx], img[iy0 - y:iy1 - y, ix0 - x:ix1 - x])
+        # One slot per ROI, each written only by the thread handling that ROI
+        oContours = [None] * len(centers)
+        oMasks = [None] * len(centers)
+        """
+        Equivalent of pcv.roi_objects (roi_type="partial") followed by pcv.object_composition for
+        the circular ROI about centers[i]. Only the objects near the ROI are looked at: those
+        whose filled outline overlaps the disk are kept, any other outline in their bounding box
+        is erased (as roi_objects does), and the remaining objects are traced once more.
+        """
+        def ProcessRoi(i: int):
+            cx, cy = centers[i]
+            x0, y0 = max(cx - radius, 0), max(cy - radius, 0)
+            x1, y1 = min(cx + radius + 1, width), min(cy + radius + 1, height)
+            disk = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            cv2.circle(disk, (cx - x0, cy - y0), radius, 255, -1)
+            near = np.flatnonzero((rects[:, 0] < x1) & (rects[:, 0] + rects[:, 2] > x0) &
+                                  (rects[:, 1] < y1) & (rects[:, 1] + rects[:, 3] > y0))
+            kept = []
+            for c in near:
+                fill, roi = Clip(c, Fill(c, False), disk, x0, y0)
+                if _Overlaps(fill, roi):
+                    kept.append(c)
+            if not kept:
+                oContours[i], oMasks[i] = [], [] # No plant in this ROI, but recognize that there was no reading
+                return
+            # Window around the kept objects, padded so that findContours sees them as in the full image
+            bx0 = max(int(rects[kept, 0].min()) - 1, 0)
+            by0 = max(int(rects[kept, 1].min()) - 1, 0)
+            bx1 = min(int((rects[kept, 0] + rects[kept, 2]).max()) + 1, width)
+            by1 = min(int((rects[kept, 1] + rects[kept, 3]).max()) + 1, height)
+            window = base[by0:by1, bx0:bx1].copy()
+            others = np.flatnonzero((rects[:, 0] < bx1) & (rects[:, 0] + rects[:, 2] > bx0) &
+                                    (rects[:, 1] < by1) & (rects[:, 1] + rects[:, 3] > by0))
+            for c in np.setdiff1d(others, kept):
+                _Erase(*Clip(c, Fill(c, True), window, bx0, by0))
+            if cv2.countNonZero(window) <= 0:
+                oContours[i], oMasks[i] = [], []
+                return
+            xCont, xHier = cv2.findContours(window, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE, offset=(bx0, by0))[-2:]
+            # As pcv.object_composition: every contour other than a childless hole makes up the plant
+            group = np.vstack([cnt for cnt, h in zip(xCont, xHier[0]) if not (h[2] == -1 and h[3] > -1)])
+            pMask = np.zeros((height, width), dtype=np.uint8)
+            cv2.drawContours(pMask, xCont, -1, 255, -1, hierarchy=xHier)
+            oContours[i], oMasks[i] = group, pMask
+        # Plants are independent of each other, so their ROIs are handled side by side
+        _Map(ProcessRoi, range(0, len(centers)))
         return (self.GetName(), SegmentationChannel(contours=oContours, masks=oMasks, rgb=rsInput.imgPrimary, tag=rsInput.tag))
 
 """
@@ -408,17 +871,7 @@ class DBSCANSegmentation(Stage):
     """
     def Invoke(self, inData: StageChannel) -> tuple:
         dbInput = cast(DoubleImageChannel, inData)
-        _, cMsks = pcv.spatial_clustering(mask=dbInput.imgSecondary, algorithm="DBSCAN", 
-                                            min_cluster_size=self.cfg.minClusterSize, max_distance=self.cfg.epsilon)
-        def extractSubMasks(topLvlMask, masks) -> list:
-            for mask in topLvlMask:
-                _, sbMsks = pcv.spatial_clustering(mask=mask, algorithm="DBSCAN", min_cluster_size=self.cfg.minClusterSize, max_distance=self.cfg.epsilon)
-                if len(sbMsks) == 1:
-                    masks.append(mask) # Best one can get with these hyperparameters
-                else:
-                    for sbMsk in extractSubMasks(topLevelMsk=sbMsks, masks=[]):
-                        masks.append(sbMsk)
-            return masks
+        cMsks = _SpatialClustering(dbInput.imgSecondary, self.cfg.minClusterSize, self.cfg.epsilon)
         retMsks = []
         retCnts = []
         for mask in cMsks:
@@ -456,10 +909,10 @@ class PlantAnalysis(Stage):
     Retrieves the pair of interface channel types that correspond to the I/O nature of this stage.
     
     Returns:
-        A pair (a, b) where [a] is a DoubleImageChannel ID and [b] is a SnapshotChannel ID.
+        A pair (a, b) where [a] is a SegmentationChannel ID and [b] is a ResultsChannel ID.
     """
     def GetInterfaceIDs(self) -> tuple:
-        return (SegmentationChannel.CHANNEL_ID, SnapshotChannel.CHANNEL_ID)
+        return (SegmentationChannel.CHANNEL_ID, ResultsChannel.CHANNEL_ID)
     
     """
     Runs the PlantAnalysis Stage's processing unit on the given input channel from a previous stage.
@@ -468,24 +921,58 @@ class PlantAnalysis(Stage):
         inData - A SegmentationChannel containing the contours and masks to analyze.
 
     Returns:
-        A pair (a, b) where [a] is the name of the Pipeline Stage (i.e., "PlantAnalysis") and [b] is an 
-        empty SnapshotChannel, since all results are saved to disk.
+        A pair (a, b) where [a] is the name of the Pipeline Stage (i.e., "PlantAnalysis") and [b] is a
+        ResultsChannel holding the (sample, trait, value, label, timestamp) rows measured for the image.
+        With the CSV filetype nothing is written here: the rows are only saved to disk by [Flush], which
+        Pipeline.FormatSet and PipelineRunner.Run call at the end of a run (Pipeline.Format does not).
+        With any other filetype, the results are instead saved to disk right away and [b] is empty.
     """
     def Invoke(self, inData: StageChannel) -> tuple:
         paInput = cast(SegmentationChannel, inData)
-        print(len(paInput.masks))
+        logger.debug("Analyzing %d masks", len(paInput.masks))
+        # Serial on purpose: analyze_object is mostly Python (holding the GIL), and pcv.outputs
+        # records the samples in the order they are analyzed, i.e. in label order
         for i in range(0, len(paInput.masks)):
-            pImg = pcv.analyze_object(paInput.rgb, obj=paInput.contours[i], mask=paInput.masks[i], label=i)
-        outputFile = (self.cfg.outfile + "_" + paInput.tag.split("image_")[1].split("/")[-1].split(".")[0] + ".csv").replace(" ", "_").replace("-", "_")
-        print("Saving results to", outputFile)
-        pcv.outputs.save_results(filename=(outputFile), outformat=self.cfg.filetype)
-        csv = pd.read_csv(outputFile)
-        time = [paInput.tag.split("image_")[1].split("/")[-1].split(".")[0]]
-        time = np.repeat(time, len(paInput.masks) * 18)
-        csv['timestamp'] = time
+            pcv.analyze_object(paInput.rgb, obj=paInput.contours[i], mask=paInput.masks[i], label=i)
+        stamp = paInput.tag.split("image_")[1].split("/")[-1].split(".")[0] # Timestamp part of the file name
+        if self.cfg.filetype.upper() != "CSV":
+            outputFile = (self.cfg.outfile + "_" + stamp + ".csv").replace(" ", "_").replace("-", "_")
+            logger.info("Saving results to %s", outputFile)
+            pcv.outputs.save_results(filename=(outputFile), outformat=self.cfg.filetype)
+            pcv.outputs.clear()
+            return (self.GetName(), ResultsChannel([]))
         try:
-            csv['timestamp'] = pd.to_datetime(csv['timestamp'], format="%Y-%m-%d %H_%M_%S")
+            when = datetime.strptime(stamp, "%Y-%m-%d %H_%M_%S")
         except ValueError:
-            csv['timestamp'] = pd.to_datetime(csv['timestamp'], format="%Y-%m-%d %H-%M-%S")
-        csv.to_csv(outputFile)
-        return (self.GetName(), SnapshotChannel([]))
\ No newline at end of file
+            when = datetime.strptime(stamp, "%Y-%m-%d %H-%M-%S")
+        # The rows travel back with the rest of the outputs (from worker processes too) to be
+        # written together by [Flush]; this image's observations must not leak into the next
+        rows = [row + (when,) for row in _ObservationRows(pcv.outputs.observations)]
+        pcv.outputs.clear()
+        return (self.GetName(), ResultsChannel(rows))
+
+    """
+    Writes the rows gathered by [Invoke] for every image of the run to a single CSV file,
+    [outfile].csv, in image order.
+
+    Parameters:
+        formatted - The FormattedData produced for each DataUnit of the run (see [Stage.Flush]).
+    """
+    def Flush(self, formatted: list):
+        if self.cfg.filetype.upper() != "CSV":
+            return # Already saved per image
+        outputFile = self.cfg.outfile + ".csv"
+        logger.info("Saving results to %s", outputFile)
+        with open(outputFile, "w", newline="") as f:
+            out = csv.writer(f, lineterminator="\n")
+            out.writerow(["", "sample", "trait", "value", "label", "timestamp"])
+            n = 0
+            for fmt in formatted:
+                if not fmt: # Invalid DataUnit
+                    continue
+                entry = fmt.proc.get(self.GetName())
+                if entry is None:
+                    continue
+                for sample, var, value, label, when in entry.rows:
+                    out.writerow([n, sample, var, _CsvNumber(value), _CsvText(label), when])
+                    n = n + 1
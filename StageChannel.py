@@ -1,4 +1,3 @@
-from random import getrandbits
 import numpy as np
 
 """
@@ -22,12 +21,24 @@ Remarks:
 class StageChannel(object):
     pass
 
+"""
+Checks that [img] is a uint8 image (as every PlantCV call in the pipeline expects) and returns
+it C-contiguous, copying only if it is not already.
+
+Raises:
+    TypeError - If [img] is of any other dtype; narrowing it here could silently wrap values.
+"""
+def _AsImage(img: np.ndarray) -> np.ndarray:
+    if img.dtype != np.uint8:
+        raise TypeError("Stage images must be uint8, not " + str(img.dtype))
+    return np.ascontiguousarray(img)
+
 """
 Represents an interface for a Pipeline Stage that either outputs or takes in a single image.
 """
 class SingleImageChannel(StageChannel):
     """Read-only field to identify this type of stage interface when checking Stage compatibility."""
-    CHANNEL_ID: int = getrandbits(256) # Read-only
+    CHANNEL_ID: int = 1 # Read-only
 
     """
     Constructs a new interface instance filled with an image.
@@ -36,14 +47,14 @@ class SingleImageChannel(StageChannel):
         img - The current NumPy equivalent of the image data to associate.
     """
     def __init__(self, img: np.ndarray):
-        self.img = img
+        self.img = _AsImage(img)
 
 """
 Represents an interface for a Pipeline Stage that either outputs or takes in two images.
 """
 class DoubleImageChannel(StageChannel):
     """Read-only field to identify this type of stage interface when checking Stage compatibility."""
-    CHANNEL_ID: int = getrandbits(256) # Read-only
+    CHANNEL_ID: int = 2 # Read-only
 
     """
     Constructs a new interface instance filled with two images.
@@ -54,8 +65,8 @@ class DoubleImageChannel(StageChannel):
         tag - 
     """
     def __init__(self, imgPrimary: np.ndarray, imgSecondary: np.ndarray, tag: str):
-        self.imgPrimary = imgPrimary
-        self.imgSecondary = imgSecondary
+        self.imgPrimary = _AsImage(imgPrimary)
+        self.imgSecondary = _AsImage(imgSecondary)
         self.tag = tag
 
 """
@@ -63,15 +74,16 @@ Represents an interface specifically for a Consildation Pipeline Stage.
 """
 class SnapshotChannel(StageChannel):
     """Read-only field to identify this type of stage interface when checking Stage compatibility."""
-    CHANNEL_ID: int = getrandbits(256) # Read-only
+    CHANNEL_ID: int = 3 # Read-only
 
     """
     Constructs a new interface instance filled with all the given FormattedData entries.
 
     Parameters:
-        formatted - The FormattedData instances to associate.
+        formatted - The outputs of the Stages run so far, keyed by Stage name
+                    (see [FormattedData.proc]).
     """
-    def __init__(self, formatted: list):
+    def __init__(self, formatted: dict):
         self.formatted = formatted
 
 """
@@ -79,7 +91,7 @@ Represents an interface for a Pipeline Stage that either inputs or outputs a lis
 """
 class SegmentationChannel(StageChannel):
     """Read-only field to identify this type of stage interface when checking Stage compatibility."""
-    CHANNEL_ID: int = getrandbits(256) # Read-only
+    CHANNEL_ID: int = 4 # Read-only
 
     """
     Constructs a new interface instance filled with two lists of contours and masks.
@@ -92,6 +104,22 @@ class SegmentationChannel(StageChannel):
     """
     def __init__(self, contours: list, masks: list, rgb: np.ndarray, tag: str):
         self.contours = contours
-        self.masks = masks
-        self.rgb = rgb
+        self.masks = [m if isinstance(m, list) else _AsImage(m) for m in masks] # [] marks an empty ROI
+        self.rgb = _AsImage(rgb)
         self.tag = tag
+
+"""
+Represents an interface for a Pipeline Stage that outputs rows of measurements.
+"""
+class ResultsChannel(StageChannel):
+    """Read-only field to identify this type of stage interface when checking Stage compatibility."""
+    CHANNEL_ID: int = 5 # Read-only
+
+    """
+    Constructs a new interface instance filled with rows of measurements.
+
+    Parameters:
+        rows - The (sample, trait, value, label, timestamp) rows measured for the image.
+    """
+    def __init__(self, rows: list):
+        self.rows = rows
@@ -1,3 +1,5 @@
+import numpy as np
+
 """
 Superclass for configuring a given Pipeline stage.
 
@@ -16,8 +18,8 @@ class WhiteBalanceConfig(StageConfig):
      Wraps parameters for pcv.white_balance.
 
      Parameters:
-        roi - A four-valued tuple (a, b, c, d) where the pixels in the rectangle 
-              formed by points (a, b) and (c, d) are used relatively to white-balance
+        roi - A four-valued tuple (x, y, w, h) where the pixels in the w-by-h rectangle
+              with top-left corner (x, y) are used relatively to white-balance
               the rest of the image.
      """
      def __init__(self, roi: tuple):
@@ -88,6 +90,9 @@ class RigidSegmentationConfig(StageConfig):
     def GetRigidType(self):
         pass
 
+    def GetCenters(self) -> np.ndarray:
+        pass
+
 """
 Used to setup a RigidSegmentationGrid Pipeline Stage.
 """
@@ -113,10 +118,29 @@ class RigidSegmentationGridConfig(RigidSegmentationConfig):
         self.rows = rows
         self.cols = cols
         self.roiType = roiType
+        self._centers = None # Built by [GetCenters] on first use
 
     def GetRigidType(self):
         return RigidSegmentationGridConfig.RIGID_TYPE
 
+    """
+     The centers of the ROIs in the grid, row by row (as pcv.roi.multi orders them).
+
+     The grid is the same for every image, so it is built in one broadcast the first
+     time it is asked for and kept on the configuration from then on.
+
+     Returns:
+        A read-only (rows * cols, 2) integer array of (x, y) centers.
+    """
+    def GetCenters(self) -> np.ndarray:
+        if self._centers is None:
+            xs = self.start[0] + np.arange(self.cols) * self.spacing[0]
+            ys = self.start[1] + np.arange(self.rows) * self.spacing[1]
+            centers = np.stack(np.broadcast_arrays(xs[None, :], ys[:, None]), axis=-1).reshape(-1, 2)
+            centers.flags.writeable = False
+            self._centers = centers
+        return self._centers
+
 """
 Used to setup a RigidSegmentationCustom Pipeline Stage.
 """
@@ -139,6 +163,13 @@ class RigidSegmentationCustomConfig(RigidSegmentationConfig):
     def GetRigidType(self):
         return RigidSegmentationCustomConfig.RIGID_TYPE
 
+    """
+     Returns:
+        The (x, y) pairs of [centers] as an (n, 2) integer array, in the same order.
+    """
+    def GetCenters(self) -> np.ndarray:
+        return np.asarray(self.centers, dtype=int).reshape(-1, 2)
+
 """
 Used to setup a DBSCANSegmentation Pipeline Stage.
 """
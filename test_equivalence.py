@@ -0,0 +1,209 @@
+"""
+Checks that the Stage helpers standing in for PlantCV calls still produce exactly what
+those calls do, so that a PlantCV (or OpenCV) upgrade that changes them is caught.
+
+Run with: python test_equivalence.py (or python -m pytest -q test_equivalence.py)
+"""
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import tempfile
+import warnings
+import cv2
+import numpy as np
+import pandas as pd
+import skimage
+from plantcv import plantcv as pcv
+import Loader
+import Stage
+from DataTypes import FormattedData
+from Stage import RigidSegmentation, PlantAnalysis, _WhiteBalance, _RotateShift, _Fill
+from StageConfig import RigidSegmentationGridConfig, RigidSegmentationCustomConfig, PlantAnalysisConfig
+from StageChannel import DoubleImageChannel, SegmentationChannel
+
+"""
+Random binary masks of overlapping blobs with holes and speckle, like a noisy plant mask.
+"""
+def _Masks(count: int, shape: tuple, seed: int) -> list:
+    rng = np.random.default_rng(seed)
+    masks = []
+    for _ in range(count):
+        m = np.zeros(shape, dtype=np.uint8)
+        for _ in range(40):
+            cv2.circle(m, (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0]))), int(rng.integers(2, 60)), 255, -1)
+            cv2.circle(m, (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0]))), int(rng.integers(1, 25)), 0, -1)
+        m[rng.random(shape) < 0.01] ^= 255
+        masks.append(m)
+    return masks
+
+"""
+Imports a fresh copy of the module [name] as if Numba were not installed, so that the NumPy
+fallbacks it defines in place of its compiled kernels can be checked too.
+"""
+def _WithoutNumba(name: str):
+    saved = sys.modules.get("numba")
+    sys.modules["numba"] = None # Makes "from numba import njit" raise ImportError
+    try:
+        spec = importlib.util.find_spec(name)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        if saved is None:
+            del sys.modules["numba"]
+        else:
+            sys.modules["numba"] = saved
+    assert module.njit is None
+    return module
+
+"""
+Whether [a] and [b] are the same arrays (or lists of them, e.g. [] for an empty ROI).
+"""
+def _Same(a, b) -> bool:
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(_Same(x, y) for x, y in zip(a, b))
+    return (isinstance(a, np.ndarray) and isinstance(b, np.ndarray) and a.shape == b.shape and
+            a.dtype == b.dtype and np.array_equal(a, b))
+
+"""
+RigidSegmentation as it was written against PlantCV: find_objects, roi.multi, then
+roi_objects and object_composition for every ROI.
+"""
+def _RigidReference(cfg, img: np.ndarray, mask: np.ndarray) -> tuple:
+    objs, objH = pcv.find_objects(img, mask)
+    if isinstance(cfg, RigidSegmentationGridConfig):
+        rois, roiH = pcv.roi.multi(img, coord=cfg.start, radius=cfg.radius, spacing=cfg.spacing, nrows=cfg.rows, ncols=cfg.cols)
+    else:
+        rois, roiH = pcv.roi.multi(img, coord=cfg.centers, radius=cfg.radius)
+    contours, masks = [], []
+    for roi, hier in zip(rois, roiH):
+        xCont, xHier, _, area = pcv.roi_objects(img, roi_contour=roi, roi_hierarchy=hier, object_contour=objs, obj_hierarchy=objH)
+        if area <= 0:
+            contours.append([])
+            masks.append([])
+        else:
+            group, pMask = pcv.object_composition(img, contours=xCont, hierarchy=xHier)
+            contours.append(group)
+            masks.append(pMask)
+    return contours, masks
+
+def test_rigid_segmentation():
+    cfgs = [RigidSegmentationGridConfig(start=(40, 40), radius=25, spacing=(50, 50), rows=4, cols=6, roiType='partial'),
+            RigidSegmentationCustomConfig(centers=[(139, 105), (220, 100), (306, 94), (60, 60), (100, 200)], radius=35)]
+    img = np.zeros((240, 360, 3), dtype=np.uint8)
+    for mask in _Masks(6, img.shape[:2], seed=1):
+        for cfg in cfgs:
+            out = RigidSegmentation(cfg).Invoke(DoubleImageChannel(img, mask, "test"))[1]
+            contours, masks = _RigidReference(cfg, img, mask)
+            assert _Same(out.contours, contours)
+            assert _Same(out.masks, masks)
+
+def test_white_balance():
+    rng = np.random.default_rng(0)
+    imgs = [rng.integers(0, 256, (100, 130, 3), dtype=np.uint8), np.full((50, 60, 3), 77, dtype=np.uint8),
+            rng.integers(0, 40, (80, 90, 3), dtype=np.uint8), rng.integers(0, 256, (70, 80), dtype=np.uint8)]
+    for img in imgs:
+        for roi in [None, (0, 0, 5, 5), (10, 10, 1, 1), (5, 5, 0, 3), (20, 30, 400, 400), [3, 4, 20, 10]]:
+            assert _Same(_WhiteBalance(img, roi), pcv.white_balance(img, roi=roi))
+
+def test_rotate_shift():
+    rng = np.random.default_rng(0)
+    imgs = [rng.integers(0, 256, (int(rng.integers(50, 300)), int(rng.integers(50, 300)), 3), dtype=np.uint8) for _ in range(4)]
+    imgs.append(rng.integers(0, 256, (120, 90), dtype=np.uint8))
+    for img in imgs:
+        for deg in (1, -1, 2.5, 0, 45, -13.3, 90):
+            for side in ("top", "bottom", "left", "right"):
+                for shift in (1, 2, 70):
+                    with contextlib.redirect_stderr(io.StringIO()): # PlantCV's warning when rotating crops
+                        ref = pcv.shift_img(pcv.rotate(img, deg, False), shift, side)
+                    assert _Same(_RotateShift(img, deg, shift, side), ref)
+
+def test_fill():
+    # scikit-image 0.26 made remove_small_objects' min_size inclusive, so pcv.fill on top of it
+    # also removes objects of exactly [size] pixels; _Fill keeps PlantCV's documented behavior
+    inclusive = tuple(int(v) for v in skimage.__version__.split(".")[:2]) >= (0, 26)
+    rng = np.random.default_rng(0)
+    masks = _Masks(4, (120, 160), seed=2) + [(rng.random((60, 80)) < 0.5).astype(np.uint8) * 255]
+    for mask in masks:
+        for size in (1, 2, 5, 50, 200):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", FutureWarning)
+                ref = pcv.fill(mask, size - 1 if inclusive else size)
+            assert _Same(_Fill(mask, size), ref)
+
+def test_lab_threshold():
+    rng = np.random.default_rng(3)
+    imgs = [rng.integers(0, 256, (60, 80, 3), dtype=np.uint8), np.full((20, 30, 3), 128, dtype=np.uint8)]
+    for module in (Stage, _WithoutNumba("Stage")): # The compiled kernel (when Numba is installed) and the fallback
+        for img in imgs:
+            for channel in ("l", "a", "B"):
+                gray = pcv.rgb2gray_lab(img, channel)
+                for threshold in (0, 127, 135, 135.5, 200.9, 255):
+                    for mx in (255, 128, 100.7):
+                        for obj in ("light", "dark", "Dark"):
+                            ref = pcv.threshold.binary(gray, threshold, mx, obj)
+                            assert _Same(module._LabThreshold(img, channel, threshold, mx, obj), ref)
+
+def test_mask_kernels():
+    rng = np.random.default_rng(4)
+    for module in (Stage, _WithoutNumba("Stage")):
+        for _ in range(20):
+            a = np.where(rng.random((40, 50)) < 0.02, 255, 0).astype(np.uint8)
+            b = np.where(rng.random((60, 70)) < 0.02, 255, 0).astype(np.uint8)[5:45, 10:60] # A strided view
+            assert module._Overlaps(a, b) == bool(np.any(a & b))
+            img, ref = b.copy(), b.copy()
+            ref[a > 0] = 0
+            module._Erase(a, img)
+            assert _Same(img, ref)
+        assert not module._Overlaps(np.zeros((3, 3), np.uint8), np.full((3, 3), 255, np.uint8))
+
+def test_strided_sum():
+    rng = np.random.default_rng(5)
+    for module in (Loader, _WithoutNumba("Loader")):
+        for shape in ((1, 1, 3), (7, 9, 3), (60, 81, 3), (33, 20, 1)):
+            img = rng.integers(0, 256, shape, dtype=np.uint8)
+            for stride in (1, 2, 3):
+                sample = img[::stride, ::stride]
+                total, count = module._StridedSum(img, stride)
+                assert (int(total), int(count)) == (int(sample.sum(dtype=np.uint64)), sample.size)
+
+def test_plant_analysis_csv():
+    stamp = "2023-02-13 16_52_27"
+    def Observe():
+        pcv.outputs.clear()
+        for sample in (0, 1):
+            pcv.outputs.add_observation(sample=sample, variable="area", trait="area", method="", scale="pixels",
+                                        datatype=int, value=1234 + sample, label="pixels")
+            pcv.outputs.add_observation(sample=sample, variable="ratio", trait="", method="", scale="",
+                                        datatype=float, value=1 / 3 + sample, label="none")
+            pcv.outputs.add_observation(sample=sample, variable="solidity", trait="", method="", scale="",
+                                        datatype=float, value=float("nan"), label="None")
+            pcv.outputs.add_observation(sample=sample, variable="in_bounds", trait="", method="", scale="",
+                                        datatype=bool, value=sample == 0, label="none")
+            pcv.outputs.add_observation(sample=sample, variable="center", trait="", method="", scale="",
+                                        datatype=tuple, value=(0.1, 2.5), label=("x", "y"))
+            pcv.outputs.add_observation(sample=sample, variable="hist", trait="", method="", scale="",
+                                        datatype=list, value=[1, 2.25, (3, 4), 0.5], label=[0, "a", "b", "NA"])
+    with tempfile.TemporaryDirectory() as out:
+        # The per-image file PlantAnalysis used to write: save_results, then a pandas round trip
+        # adding the timestamp (read back exactly here; pandas' default parser can be an ulp off)
+        Observe()
+        refFile = os.path.join(out, "ref.csv")
+        pcv.outputs.save_results(filename=refFile, outformat="csv")
+        table = pd.read_csv(refFile, float_precision="round_trip")
+        table["timestamp"] = pd.to_datetime(np.repeat([stamp], len(table)), format="%Y-%m-%d %H_%M_%S")
+        table.to_csv(refFile)
+        Observe()
+        analysis = PlantAnalysis(PlantAnalysisConfig(filetype="csv", outfile=os.path.join(out, "data")))
+        seg = SegmentationChannel(contours=[], masks=[], rgb=np.zeros((2, 2, 3), np.uint8), tag="/images/image_" + stamp + ".jpg")
+        name, results = analysis.Invoke(seg)
+        analysis.Flush([0, FormattedData(base=None, proc={name: results})]) # With an invalid DataUnit first
+        with open(refFile) as ref, open(os.path.join(out, "data.csv")) as got:
+            assert got.read() == ref.read()
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")